@@ -80,6 +80,13 @@ with app.app_context():
     except Exception as e:
         print(f"Error migrating database: {e}")
     
+    # create_all skips tables that already exist, so add any missing indexes
+    try:
+        for index in [*TelegramMessage.__table__.indexes, *SyncStatus.__table__.indexes]:
+            index.create(db.engine, checkfirst=True)
+    except Exception as e:
+        logger.warning(f"Error creating indexes: {str(e)}")
+    
     # Create admin user if it doesn't exist
     try:
         admin = User.query.filter_by(username="admin").first()
@@ -138,13 +145,10 @@ def index():
 def serve_media(filename):
     """Serve media files from local storage"""
     from flask import send_from_directory
-    import os
-    
-    # Construct the full path
-    media_dir = os.path.join(os.getcwd(), 'media')
+    from storage import MEDIA_DIR
     
     # Serve the file
-    return send_from_directory(media_dir, filename)
+    return send_from_directory(MEDIA_DIR, filename)
 
 @app.route('/object-storage/<path:object_name>')
 def serve_object_storage(object_name):
@@ -353,9 +357,10 @@ def get_stats():
 
 @app.route('/telegram/webhook', methods=['POST'])
 def telegram_webhook():
+    raw_body = request.get_data()
     update = request.get_json()
     logger.debug(f"Received Telegram update: {update}")
-    return handle_telegram_update(update)
+    return handle_telegram_update(update, raw_body)
 
 @app.route('/api/setup_webhook', methods=['POST'])
 @login_required
@@ -33,12 +33,26 @@ class TelegramMessage(db.Model):
     media_filename = db.Column(db.String(255), nullable=True)  # Original filename
     media_content_type = db.Column(db.String(100), nullable=True)  # MIME type
     
+    # Rows arrive in timestamp order, so a BRIN index serves date range
+    # scans at a fraction of a B-tree's size
+    __table_args__ = (
+        db.Index('ix_telegram_message_timestamp_brin', 'timestamp', postgresql_using='brin'),
+    )
+    
     def set_message_data(self, message_data):
         self.message_data = json.dumps(message_data)
     
+    def set_message_data_raw(self, raw_update):
+        """Store the webhook update body as received, without re-serializing it"""
+        self.message_data = raw_update.decode('utf-8') if isinstance(raw_update, bytes) else raw_update
+    
     def get_message_data(self):
         if self.message_data:
-            return json.loads(self.message_data)
+            data = json.loads(self.message_data)
+            # Raw webhook updates wrap the message itself
+            if 'update_id' in data:
+                return data.get('message')
+            return data
         return None
         
     def get_media_url(self):
@@ -60,6 +74,11 @@ class SyncStatus(db.Model):
     success = db.Column(db.Boolean, default=True)
     error_message = db.Column(db.Text, nullable=True)
     
+    # Date range scans for the daily success/failure counts
+    __table_args__ = (
+        db.Index('ix_sync_status_timestamp', 'timestamp', postgresql_where=db.text('success IS NOT NULL')),
+    )
+    
 class Setting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(255), unique=True, nullable=False)
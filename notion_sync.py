@@ -1,11 +1,17 @@
 import os
+import re
 import json
+import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
 from datetime import datetime, timedelta
-from notion_client import Client
+from notion_client import Client, APIResponseError
 from sqlalchemy import func
 from app import db
 from models import TelegramMessage, SyncStatus, Setting
+from telegram_bot import MEDIA_PENDING, retry_pending_media
 
 # Initialize logger
 logger = logging.getLogger('notion_sync')
@@ -16,18 +22,34 @@ if not logger.handlers:
     logger.addHandler(console_handler)
     logger.setLevel(logging.INFO)
 
+# Notion configuration, read once from Replit Secrets at import
+NOTION_INTEGRATION_SECRET = os.environ.get("NOTION_INTEGRATION_SECRET")
+NOTION_PAGE_ID = os.environ.get("NOTION_PAGE_ID")
+
+# Maximum number of dates synced to Notion concurrently
+SYNC_MAX_WORKERS = 5
+
+# How long a successful parent page check is trusted before re-verifying
+PARENT_PAGE_VERIFY_TTL = 3600
+
+# Time of the last successful parent page check (None forces a check)
+_parent_page_verified_at = None
+
+def invalidate_parent_page_verification(error):
+    """Force the parent page to be re-verified after a 401/404 from Notion"""
+    global _parent_page_verified_at
+    if isinstance(error, APIResponseError) and error.status in (401, 404):
+        _parent_page_verified_at = None
+
 def get_notion_client():
     """Get Notion client from environment secrets"""
-    import os
-    notion_secret = os.environ.get("NOTION_INTEGRATION_SECRET")
-    if notion_secret:
-        return Client(auth=notion_secret)
+    if NOTION_INTEGRATION_SECRET:
+        return Client(auth=NOTION_INTEGRATION_SECRET)
     return None
 
 def get_notion_page_id():
     """Get Notion page ID from environment secrets"""
-    import os
-    return os.environ.get("NOTION_PAGE_ID")
+    return NOTION_PAGE_ID
 
 def create_monthly_database(client, parent_page_id, year, month):
     """Create a new database for the given month"""
@@ -59,6 +81,7 @@ def create_monthly_database(client, parent_page_id, year, month):
         return response["id"]
     except Exception as e:
         logger.error(f"Error creating monthly database: {str(e)}")
+        invalidate_parent_page_verification(e)
         return None
 
 def create_daily_page(client, monthly_database_id, date):
@@ -98,10 +121,45 @@ def create_daily_page(client, monthly_database_id, date):
         logger.error(f"Error creating daily page: {str(e)}")
         return None
 
+# URLs in message text are turned into links
+URL_PATTERN = re.compile(r'(https?://[^\s]+)')
+
+def _text(content, url=None):
+    """Build a single rich text item, optionally linked to url"""
+    text = {"content": content}
+    if url:
+        text["link"] = {"url": url}
+    return {"type": "text", "text": text}
+
+def _paragraph(rich_text):
+    """Build a paragraph block from a list of rich text items"""
+    return {
+        "object": "block",
+        "type": "paragraph",
+        "paragraph": {
+            "rich_text": rich_text
+        }
+    }
+
+def _linkify(text):
+    """Split text into rich text items with URLs as links"""
+    # re.split with a capturing group alternates text and URL parts
+    parts = URL_PATTERN.split(text)
+    if len(parts) == 1:
+        # No URLs, just add the text as is
+        return [_text(text)]
+    
+    rich_text = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:  # Regular text
+            if part:  # Only add if not empty
+                rich_text.append(_text(part))
+        else:  # URL part
+            rich_text.append(_text(part, url=part))
+    return rich_text
+
 def format_message_for_notion(message):
     """Format a Telegram message for Notion with URL detection and media handling"""
-    import re
-    
     timestamp = message.timestamp.strftime("%H:%M:%S")
     username = message.username if message.username else f"{message.first_name} {message.last_name}".strip()
     
@@ -112,376 +170,298 @@ def format_message_for_notion(message):
         
         # Handle different media types
         if message.media_type == 'image':
-            # Create an image block for the media
-            image_block = {
-                "object": "block",
-                "type": "image",
-                "image": {
-                    "type": "external",
-                    "external": {"url": media_url}
-                }
-            }
-            
-            # Create a text block for caption/metadata
-            caption_blocks = []
-            
             # Header with timestamp and username
-            caption_blocks.append({
-                "type": "text", 
-                "text": {"content": f"**{timestamp}** - **{username}** shared an image: "}
-            })
+            caption_blocks = [_text(f"**{timestamp}** - **{username}** shared an image: ")]
             
-            # If there's a caption, add it
+            # If there's a caption, add it with URL detection
             if message.text:
-                # Add URL detection for the caption
-                url_pattern = r'(https?://[^\s]+)'
-                
-                # Check if the text contains URLs
-                if re.search(url_pattern, message.text):
-                    # Split text by URLs
-                    parts = re.split(url_pattern, message.text)
-                    
-                    # Build text blocks with URLs as links
-                    for i, part in enumerate(parts):
-                        if i % 2 == 0:  # Regular text
-                            if part:  # Only add if not empty
-                                caption_blocks.append({
-                                    "type": "text",
-                                    "text": {"content": part}
-                                })
-                        else:  # URL part
-                            caption_blocks.append({
-                                "type": "text",
-                                "text": {
-                                    "content": part,
-                                    "link": {"url": part}
-                                }
-                            })
-                else:
-                    # No URLs, just add the text as is
-                    caption_blocks.append({
-                        "type": "text",
-                        "text": {"content": message.text}
-                    })
+                caption_blocks.extend(_linkify(message.text))
             
-            # Return both blocks (image and caption)
+            # Return both blocks (caption and image)
             return [
+                _paragraph(caption_blocks),
                 {
                     "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {
-                        "rich_text": caption_blocks
+                    "type": "image",
+                    "image": {
+                        "type": "external",
+                        "external": {"url": media_url}
                     }
-                },
-                image_block
+                }
             ]
             
         elif message.media_type in ['document', 'video', 'audio']:
             # For non-image media, create a rich text block with file link
-            media_blocks = []
+            media_blocks = [
+                # Header with timestamp and username
+                _text(f"**{timestamp}** - **{username}** shared a {message.media_type}: "),
+                # Add a link to the file
+                _text(message.media_filename or f"{message.media_type} file", url=media_url)
+            ]
             
-            # Header with timestamp and username
-            header_text = f"**{timestamp}** - **{username}** shared a {message.media_type}: "
+            # If there's a caption, add it
+            if message.text:
+                media_blocks.append(_text(f" - {message.text}"))
             
-            media_blocks.append({
-                "type": "text", 
-                "text": {"content": header_text}
-            })
+            return _paragraph(media_blocks)
+    
+    # Regular text message handling: header (timestamp and username) then text
+    rich_text_blocks = [_text(f"**{timestamp}** - **{username}**: ")]
+    rich_text_blocks.extend(_linkify(message.text))
+    
+    return _paragraph(rich_text_blocks)
+
+def find_or_create_monthly_database(client, parent_page_id, date, db_cache):
+    """Get the monthly database for a date, creating it if needed.
+
+    db_cache is shared between sync workers, so lookup and creation happen
+    under its lock to stop two dates in the same month creating duplicates.
+    """
+    year = date.year
+    month = date.month
+    month_name = date.strftime("%B")
+    
+    with db_cache["lock"]:
+        monthly_db_id = db_cache["databases"].get((year, month))
+        if monthly_db_id:
+            return monthly_db_id
+        
+        # Try to find the monthly database by listing child blocks
+        try:
+            # Create the database title to search for
+            month_db_title = f"Messages {month_name} {year}"
+            logger.debug(f"Looking for monthly database: '{month_db_title}'")
             
-            # Add a link to the file
-            media_blocks.append({
-                "type": "text",
-                "text": {
-                    "content": message.media_filename or f"{message.media_type} file",
-                    "link": {"url": media_url}
-                }
-            })
+            # First, search for existing monthly databases in the parent page
+            children_results = client.blocks.children.list(block_id=parent_page_id)["results"]
+            logger.debug(f"Found {len(children_results)} child blocks in parent page")
             
-            # If there's a caption, add it
-            if message.text:
-                media_blocks.append({
-                    "type": "text",
-                    "text": {"content": f" - {message.text}"}
-                })
+            # Look for child database blocks with matching title
+            for block in children_results:
+                if block["type"] == "child_database":
+                    block_id = block["id"]
+                    logger.debug(f"Found child database with ID: {block_id}")
+                    
+                    # Fetch database details to check title
+                    db_details = client.databases.retrieve(database_id=block_id)
+                    
+                    # Extract title text
+                    title = "".join(text["plain_text"] for text in db_details["title"])
+                    logger.debug(f"Database title: '{title}'")
+                    
+                    if title == month_db_title:
+                        logger.debug(f"Found matching monthly database with ID: {block_id}")
+                        monthly_db_id = block_id
+                        break
             
-            return {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": media_blocks
+            if not monthly_db_id:
+                logger.debug(f"No matching monthly database found for '{month_db_title}'")
+        except Exception as e:
+            logger.error(f"Error searching for monthly database: {str(e)}", exc_info=True)
+            invalidate_parent_page_verification(e)
+        
+        # If not found, create new monthly database
+        if not monthly_db_id:
+            logger.debug(f"Creating new monthly database for {month_name} {year}")
+            monthly_db_id = create_monthly_database(client, parent_page_id, year, month)
+        
+        if monthly_db_id:
+            db_cache["databases"][(year, month)] = monthly_db_id
+        return monthly_db_id
+
+def _sync_one_date(notion_client, parent_page_id, date, formatted_messages, message_count, db_cache):
+    """Append one day's formatted messages to its daily page.
+
+    Returns the daily page ID on success, or None if the day failed.
+    """
+    monthly_db_id = find_or_create_monthly_database(notion_client, parent_page_id, date, db_cache)
+    
+    if not monthly_db_id:
+        logger.error(f"Failed to get or create monthly database for {date.year}-{date.month}")
+        return None
+    
+    # Get or create daily page
+    daily_page_id = None
+    
+    # Try to find the daily page
+    try:
+        logger.debug(f"Searching for daily page for date: {date.strftime('%Y-%m-%d')} in database: {monthly_db_id}")
+        daily_pages = notion_client.databases.query(
+            database_id=monthly_db_id,
+            filter={
+                "property": "Date",
+                "date": {
+                    "equals": date.strftime("%Y-%m-%d")
                 }
             }
+        )
+        
+        results = daily_pages["results"]
+        logger.debug(f"Found {len(results)} matching daily pages")
+        if results:
+            daily_page_id = results[0]["id"]
+            logger.debug(f"Using existing daily page: {daily_page_id}")
+    except Exception as e:
+        logger.error(f"Error searching for daily page: {str(e)}", exc_info=True)
     
-    # Regular text message handling
-    # Header part (timestamp and username)
-    header_text = f"**{timestamp}** - **{username}**: "
-    
-    # Start building rich text blocks
-    rich_text_blocks = [
-        {
-            "type": "text", 
-            "text": {"content": header_text}
-        }
-    ]
+    if not daily_page_id:
+        # Create new daily page
+        logger.debug(f"Creating new daily page for date: {date.strftime('%Y-%m-%d')}")
+        daily_page_id = create_daily_page(notion_client, monthly_db_id, date)
+        if daily_page_id:
+            logger.debug(f"Created new daily page with ID: {daily_page_id}")
+        else:
+            logger.error("Failed to create daily page")
     
-    # URL regex pattern
-    url_pattern = r'(https?://[^\s]+)'
+    if not daily_page_id:
+        logger.error(f"Failed to get or create daily page for {date}")
+        return None
     
-    # Check if the message contains URLs
-    if re.search(url_pattern, message.text):
-        # Split text by URLs
-        parts = re.split(url_pattern, message.text)
+    try:
+        # Update daily page with messages
+        logger.debug(f"Appending {len(formatted_messages)} message blocks to daily page {daily_page_id}")
+        append_response = notion_client.blocks.children.append(
+            block_id=daily_page_id,
+            children=formatted_messages
+        )
+        logger.debug(f"Successfully appended blocks to page")
         
-        # Build rich text blocks with URLs as links
-        for i, part in enumerate(parts):
-            if i % 2 == 0:  # Regular text
-                if part:  # Only add if not empty
-                    rich_text_blocks.append({
-                        "type": "text",
-                        "text": {"content": part}
-                    })
-            else:  # URL part
-                rich_text_blocks.append({
-                    "type": "text",
-                    "text": {
-                        "content": part,
-                        "link": {"url": part}
-                    }
-                })
-    else:
-        # No URLs, just add the text as is
-        rich_text_blocks.append({
-            "type": "text",
-            "text": {"content": message.text}
-        })
-    
-    return {
-        "object": "block",
-        "type": "paragraph",
-        "paragraph": {
-            "rich_text": rich_text_blocks
-        }
-    }
+        # Get current message count if available
+        current_count = 0
+        try:
+            page_info = notion_client.pages.retrieve(page_id=daily_page_id)
+            if page_info["properties"]["Messages"]["number"] is not None:
+                current_count = page_info["properties"]["Messages"]["number"]
+                logger.debug(f"Current message count: {current_count}")
+        except Exception as e:
+            logger.warning(f"Could not retrieve current message count: {str(e)}")
+        
+        # Update messages count in the daily page (increment existing count)
+        new_count = current_count + message_count
+        logger.debug(f"Updating page properties to show {new_count} messages (added {message_count} new)")
+        update_response = notion_client.pages.update(
+            page_id=daily_page_id,
+            properties={
+                "Messages": {"number": new_count},
+                "Status": {"select": {"name": "Synced"}}
+            }
+        )
+        logger.debug(f"Successfully updated page properties")
+        
+        return daily_page_id
+    except Exception as e:
+        logger.error(f"Error syncing messages to daily page: {str(e)}", exc_info=True)
+        return None
 
 def sync_messages_to_notion():
     """Sync unsynced messages to Notion"""
+    global _parent_page_verified_at
     logger.info("Starting Notion sync...")
     
-    # Get Notion client and parent page ID
-    notion_client = get_notion_client()
-    parent_page_id = get_notion_page_id()  # Top level page ID that will contain monthly databases
+    # Outcome of this run, recorded as a single SyncStatus row on exit
+    total_synced = 0
+    error_msg = None
     
-    # Validate Notion client
-    if not notion_client:
-        error_msg = "Notion client not available - check your NOTION_INTEGRATION_SECRET environment variable"
-        logger.error(error_msg)
-        sync_status = SyncStatus()
-        sync_status.messages_synced = 0
-        sync_status.success = False
-        sync_status.error_message = error_msg
-        db.session.add(sync_status)
-        db.session.commit()
-        return
+    try:
+        # Get Notion client and parent page ID
+        notion_client = get_notion_client()
+        parent_page_id = get_notion_page_id()  # Top level page ID that will contain monthly databases
         
-    # Validate parent page ID
-    if not parent_page_id:
-        error_msg = "Notion page ID not configured - check your NOTION_PAGE_ID environment variable"
-        logger.error(error_msg)
-        sync_status = SyncStatus()
-        sync_status.messages_synced = 0
-        sync_status.success = False
-        sync_status.error_message = error_msg
-        db.session.add(sync_status)
-        db.session.commit()
-        return
+        # Validate Notion client
+        if not notion_client:
+            error_msg = "Notion client not available - check your NOTION_INTEGRATION_SECRET environment variable"
+            logger.error(error_msg)
+            return
+            
+        # Validate parent page ID
+        if not parent_page_id:
+            error_msg = "Notion page ID not configured - check your NOTION_PAGE_ID environment variable"
+            logger.error(error_msg)
+            return
+            
+        # Log debug info
+        logger.debug(f"Using Notion page ID: {parent_page_id}")
         
-    # Log debug info
-    logger.debug(f"Using Notion page ID: {parent_page_id}")
-    
-    # Verify Notion page exists
-    try:
-        logger.debug("Verifying parent page exists...")
-        page_info = notion_client.pages.retrieve(page_id=parent_page_id)
-        if isinstance(page_info, dict):
-            logger.debug(f"Successfully verified parent page: {page_info.get('id')}")
+        # Verify Notion page exists (cached for PARENT_PAGE_VERIFY_TTL seconds)
+        if time.time() - (_parent_page_verified_at or 0) > PARENT_PAGE_VERIFY_TTL:
+            try:
+                logger.debug("Verifying parent page exists...")
+                page_info = notion_client.pages.retrieve(page_id=parent_page_id)
+                logger.debug(f"Successfully verified parent page: {page_info['id']}")
+                _parent_page_verified_at = time.time()
+            except Exception as e:
+                error_msg = f"Error accessing Notion page with ID {parent_page_id}: {str(e)}"
+                logger.error(error_msg)
+                return
         else:
-            logger.debug(f"Successfully verified parent page exists (ID: {parent_page_id})")
-    except Exception as e:
-        error_msg = f"Error accessing Notion page with ID {parent_page_id}: {str(e)}"
-        logger.error(error_msg)
-        sync_status = SyncStatus()
-        sync_status.messages_synced = 0
-        sync_status.success = False
-        sync_status.error_message = error_msg
-        db.session.add(sync_status)
-        db.session.commit()
-        return
-    
-    try:
-        # Get unsynced messages
-        unsynced_messages = TelegramMessage.query.filter_by(synced=False).order_by(TelegramMessage.timestamp).all()
+            logger.debug("Parent page verified recently, skipping check")
+        
+        # Retry media downloads that never finished, so their messages can sync
+        try:
+            retry_pending_media()
+        except Exception as e:
+            logger.error(f"Error retrying pending media downloads: {str(e)}")
+            db.session.rollback()
+        
+        # Get unsynced messages, leaving those still waiting on their media
+        # for a later run
+        unsynced_messages = (
+            TelegramMessage.query
+            .filter_by(synced=False)
+            .filter(~MEDIA_PENDING)
+            .order_by(TelegramMessage.timestamp)
+            .all()
+        )
         
         if not unsynced_messages:
             logger.info("No unsynced messages found")
-            sync_status = SyncStatus()
-            sync_status.messages_synced = 0
-            sync_status.success = True
-            db.session.add(sync_status)
-            db.session.commit()
             return
         
-        # Group messages by date
-        messages_by_date = {}
-        for message in unsynced_messages:
-            date_key = message.timestamp.date()
-            if date_key not in messages_by_date:
-                messages_by_date[date_key] = []
-            messages_by_date[date_key].append(message)
+        # Group messages by date; the query is ordered by timestamp, so each
+        # date forms one consecutive run and groups come out chronologically
+        messages_by_date = [
+            (date, list(group))
+            for date, group in groupby(unsynced_messages, key=lambda m: m.timestamp.date())
+        ]
         
-        # Process messages by date
+        # Process dates in parallel; each date only talks to Notion, and the
+        # database session is only touched from this thread
         total_synced = 0
+        db_cache = {"lock": threading.Lock(), "databases": {}}
         
-        for date, messages in messages_by_date.items():
-            year = date.year
-            month = date.month
-            month_name = date.strftime("%B")
-            
-            # Get or create monthly database
-            monthly_db_id = None
-            
-            # Try to find the monthly database by listing child blocks
-            try:
-                # Create the database title to search for
-                month_db_title = f"Messages {month_name} {year}"
-                logger.debug(f"Looking for monthly database: '{month_db_title}'")
-                
-                # First, search for existing monthly databases in the parent page
-                children_response = notion_client.blocks.children.list(block_id=parent_page_id)
-                logger.debug(f"Found {len(children_response.get('results', []))} child blocks in parent page")
-                
-                # Look for child database blocks with matching title
-                children_results = children_response.get("results", []) if isinstance(children_response, dict) else []
-                for block in children_results:
-                    if block.get("type") == "child_database":
-                        block_id = block.get("id")
-                        logger.debug(f"Found child database with ID: {block_id}")
-                        
-                        # Fetch database details to check title
-                        db_details = notion_client.databases.retrieve(database_id=block_id)
-                        db_title = db_details.get("title", []) if isinstance(db_details, dict) else []
-                        
-                        # Extract title text
-                        title_parts = []
-                        for text in db_title:
-                            if isinstance(text, dict) and "text" in text:
-                                title_parts.append(text["text"].get("content", ""))
-                        title = "".join(title_parts)
-                        logger.debug(f"Database title: '{title}'")
-                        
-                        if title == month_db_title:
-                            logger.debug(f"Found matching monthly database with ID: {block_id}")
-                            monthly_db_id = block_id
-                            break
+        with ThreadPoolExecutor(max_workers=SYNC_MAX_WORKERS) as executor:
+            futures = {}
+            for date, messages in messages_by_date:
+                # Format messages here rather than in the worker: media URLs
+                # are resolved from the current request context
+                logger.debug(f"Formatting {len(messages)} messages for Notion")
+                formatted_messages = []
+                for message in messages:
+                    # Get formatted message blocks
+                    message_blocks = format_message_for_notion(message)
+                    
+                    # Handle both single blocks and lists of blocks
+                    if isinstance(message_blocks, list):
+                        formatted_messages.extend(message_blocks)
+                    else:
+                        formatted_messages.append(message_blocks)
                 
-                if not monthly_db_id:
-                    logger.debug(f"No matching monthly database found for '{month_db_title}'")
-            except Exception as e:
-                logger.error(f"Error searching for monthly database: {str(e)}", exc_info=True)
-            
-            # If not found, create new monthly database
-            if not monthly_db_id:
-                logger.debug(f"Creating new monthly database for {month_name} {year}")
-                monthly_db_id = create_monthly_database(notion_client, parent_page_id, year, month)
-            
-            if not monthly_db_id:
-                logger.error(f"Failed to get or create monthly database for {year}-{month}")
-                continue
-            
-            # Get or create daily page
-            daily_page_id = None
-            
-            # Try to find the daily page
-            try:
-                logger.debug(f"Searching for daily page for date: {date.strftime('%Y-%m-%d')} in database: {monthly_db_id}")
-                daily_pages = notion_client.databases.query(
-                    database_id=monthly_db_id,
-                    filter={
-                        "property": "Date",
-                        "date": {
-                            "equals": date.strftime("%Y-%m-%d")
-                        }
-                    }
+                future = executor.submit(
+                    _sync_one_date,
+                    notion_client,
+                    parent_page_id,
+                    date,
+                    formatted_messages,
+                    len(messages),
+                    db_cache
                 )
-                
-                if isinstance(daily_pages, dict):
-                    results = daily_pages.get("results", [])
-                    logger.debug(f"Found {len(results)} matching daily pages")
-                    if results:
-                        daily_page_id = results[0]["id"]
-                        logger.debug(f"Using existing daily page: {daily_page_id}")
-                else:
-                    logger.debug(f"Query response is not a dictionary: {type(daily_pages)}")
-            except Exception as e:
-                logger.error(f"Error searching for daily page: {str(e)}", exc_info=True)
-            
-            if not daily_page_id:
-                # Create new daily page
-                logger.debug(f"Creating new daily page for date: {date.strftime('%Y-%m-%d')}")
-                daily_page_id = create_daily_page(notion_client, monthly_db_id, date)
-                if daily_page_id:
-                    logger.debug(f"Created new daily page with ID: {daily_page_id}")
-                else:
-                    logger.error("Failed to create daily page")
-            
-            if not daily_page_id:
-                logger.error(f"Failed to get or create daily page for {date}")
-                continue
-            
-            # Format messages for Notion
-            logger.debug(f"Formatting {len(messages)} messages for Notion")
-            formatted_messages = []
-            for message in messages:
-                # Get formatted message blocks
-                message_blocks = format_message_for_notion(message)
-                
-                # Handle both single blocks and lists of blocks
-                if isinstance(message_blocks, list):
-                    formatted_messages.extend(message_blocks)
-                else:
-                    formatted_messages.append(message_blocks)
+                futures[future] = (date, messages)
             
-            try:
-                # Update daily page with messages
-                logger.debug(f"Appending {len(formatted_messages)} message blocks to daily page {daily_page_id}")
-                append_response = notion_client.blocks.children.append(
-                    block_id=daily_page_id,
-                    children=formatted_messages
-                )
-                logger.debug(f"Successfully appended blocks to page")
-                
-                # Get current message count if available
-                current_count = 0
-                try:
-                    page_info = notion_client.pages.retrieve(page_id=daily_page_id)
-                    if isinstance(page_info, dict) and "properties" in page_info:
-                        message_prop = page_info["properties"].get("Messages", {})
-                        if "number" in message_prop and message_prop["number"] is not None:
-                            current_count = message_prop["number"]
-                            logger.debug(f"Current message count: {current_count}")
-                except Exception as e:
-                    logger.warning(f"Could not retrieve current message count: {str(e)}")
-                
-                # Update messages count in the daily page (increment existing count)
-                new_count = current_count + len(messages)
-                logger.debug(f"Updating page properties to show {new_count} messages (added {len(messages)} new)")
-                update_response = notion_client.pages.update(
-                    page_id=daily_page_id,
-                    properties={
-                        "Messages": {"number": new_count},
-                        "Status": {"select": {"name": "Synced"}}
-                    }
-                )
-                logger.debug(f"Successfully updated page properties")
+            for future in as_completed(futures):
+                date, messages = futures[future]
+                daily_page_id = future.result()
+                if not daily_page_id:
+                    continue
                 
                 # Mark messages as synced
                 for message in messages:
@@ -490,29 +470,23 @@ def sync_messages_to_notion():
                 
                 total_synced += len(messages)
                 logger.info(f"Successfully synced {len(messages)} messages for {date}")
-            except Exception as e:
-                logger.error(f"Error syncing messages to daily page: {str(e)}", exc_info=True)
-                continue
-        
-        # Commit changes to database
-        db.session.commit()
-        
-        # Create sync status record
-        sync_status = SyncStatus()
-        sync_status.messages_synced = total_synced
-        sync_status.success = True
-        db.session.add(sync_status)
-        db.session.commit()
         
         logger.info(f"Successfully synced {total_synced} messages to Notion")
         
     except Exception as e:
         logger.error(f"Error syncing messages to Notion: {str(e)}")
-        
-        # Create failed sync status
+        total_synced = 0
+        error_msg = str(e)
+    
+    finally:
+        # Record the sync status and commit it together with the message updates
         sync_status = SyncStatus()
-        sync_status.messages_synced = 0
-        sync_status.success = False
-        sync_status.error_message = str(e)
+        sync_status.messages_synced = total_synced
+        sync_status.success = error_msg is None
+        sync_status.error_message = error_msg
         db.session.add(sync_status)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except Exception as e:
+            logger.error(f"Error saving sync status: {str(e)}")
+            db.session.rollback()
@@ -5,9 +5,22 @@ This script transfers recent backups from Replit Object Storage to AWS S3 for of
 It runs weekly to ensure your data is safely stored in multiple locations.
 """
 import os
-import io
+import re
+import json
+import functools
+import time
+import random
 import logging
+import tempfile
+import threading
+import multiprocessing
 import boto3
+from collections import namedtuple
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from storage import STORAGE_CLIENT
 
@@ -19,12 +32,68 @@ logger = logging.getLogger('offsite_backup')
 # AWS S3 configuration
 S3_BUCKET_NAME = os.environ.get("REPLIT_AWS_S3_BUCKET", "").strip()  # Get bucket name from Replit Secrets and remove any trailing spaces
 
+# Backup object names: backups/backup_YYYY-MM-DD_type.sql.gz
+BACKUP_NAME_PATTERN = re.compile(r'^backups/backup_(\d{4})-(\d{2})-(\d{2})_')
+
+# Number of backups transferred to S3 concurrently
+TRANSFER_MAX_WORKERS = 8
+
+# Batches larger than this are transferred with a process pool
+PROCESS_POOL_THRESHOLD = 50
+PROCESS_POOL_MAX_WORKERS = 4
+
+# S3 transfer settings by backup size, as (size limit, settings) pairs:
+# small backups go in a single PUT without threads, larger ones use bigger
+# multipart chunks and more parallel parts
+TRANSFER_TIERS = [
+    (8 * 1024 * 1024, TransferConfig(use_threads=False)),
+    (256 * 1024 * 1024, TransferConfig(
+        multipart_threshold=8 * 1024 * 1024,
+        multipart_chunksize=8 * 1024 * 1024,
+        max_concurrency=4
+    )),
+    (float('inf'), TransferConfig(
+        multipart_threshold=16 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=10
+    )),
+]
+
+# Connection pool size for the shared S3 client: one connection for every
+# part that TRANSFER_MAX_WORKERS concurrent transfers can upload at once
+S3_MAX_POOL_CONNECTIONS = TRANSFER_MAX_WORKERS * max(
+    transfer_config.max_concurrency if transfer_config.use_threads else 1
+    for _, transfer_config in TRANSFER_TIERS
+)
+
+# Shared S3 client, created lazily by get_s3_client()
+_S3_CLIENT = None
+_S3_LOCK = threading.Lock()
+
+# Retry settings for a single backup transfer
+TRANSFER_MAX_ATTEMPTS = 3
+TRANSFER_RETRY_MAX_WAIT = 30  # seconds
+
+# S3 errors that reach us only after the client's own retries (see
+# get_s3_client); retrying them here would repeat the whole download and
+# upload, so only other failures, such as Replit downloads, are retried
+S3_RETRIED_ERRORS = (BotoCoreError, ClientError, S3UploadFailedError)
+
+# Local log of completed transfers, one JSON object per line, so a restarted
+# run can skip backups that already reached S3
+TRANSFER_LOG_FILE = os.path.join("backups", "offsite_transfer.log")
+_TRANSFER_LOG_LOCK = threading.Lock()
+
+# AWS credentials as read from Replit Secrets
+AwsCredentials = namedtuple("AwsCredentials", ["access_key_id", "secret_access_key"])
+
+@functools.lru_cache(maxsize=1)
 def get_aws_credentials():
-    """Get AWS credentials from Replit Secrets"""
-    return {
-        "aws_access_key_id": os.environ.get("REPLIT_AWS_ACCESS_KEY_ID", ""),
-        "aws_secret_access_key": os.environ.get("REPLIT_AWS_SECRET_ACCESS_KEY", "")
-    }
+    """Get AWS credentials from Replit Secrets (read once and cached)"""
+    return AwsCredentials(
+        access_key_id=os.environ.get("REPLIT_AWS_ACCESS_KEY_ID", ""),
+        secret_access_key=os.environ.get("REPLIT_AWS_SECRET_ACCESS_KEY", "")
+    )
 
 def list_recent_backups(days=7):
     """List backups created in the last X days"""
@@ -33,28 +102,23 @@ def list_recent_backups(days=7):
         return []
     
     try:
-        # List all backups
-        all_objects = STORAGE_CLIENT.list()
-        backup_objects = [obj for obj in all_objects 
-                         if isinstance(obj, str) and obj.startswith("backups/backup_")]
+        # Backup names embed their date (backups/backup_YYYY-MM-DD_type.sql.gz),
+        # so they sort by date and the listing can start at the cutoff day
+        # instead of scanning the whole bucket
+        cutoff_date = datetime.now() - timedelta(days=days)
+        start_offset = f"backups/backup_{cutoff_date.strftime('%Y-%m-%d')}"
+        
+        recent_objects = STORAGE_CLIENT.list(prefix="backups/backup_", start_offset=start_offset)
         
-        # Filter by date in filename (backup_YYYY-MM-DD_type.sql.gz)
+        # Filter by date in filename; names after the offset that are not
+        # dated backups are skipped
+        cutoff = (cutoff_date.year, cutoff_date.month, cutoff_date.day)
         recent_backups = []
-        cutoff_date = datetime.now() - timedelta(days=days)
         
-        for backup in backup_objects:
-            try:
-                # Extract date from filename
-                filename = backup.split('/')[-1]  # Get just the filename
-                date_str = filename.split('_')[1]  # Get the YYYY-MM-DD part
-                backup_date = datetime.strptime(date_str, "%Y-%m-%d")
-                
-                # Check if it's recent
-                if backup_date >= cutoff_date:
-                    recent_backups.append(backup)
-            except Exception:
-                # If we can't parse the date, skip this file
-                continue
+        for obj in recent_objects:
+            match = BACKUP_NAME_PATTERN.match(obj.name)
+            if match and tuple(map(int, match.groups())) >= cutoff:
+                recent_backups.append(obj.name)
         
         return recent_backups
     
@@ -62,51 +126,167 @@ def list_recent_backups(days=7):
         logger.error(f"Error listing recent backups: {str(e)}")
         return []
 
-def transfer_to_s3(backup_name):
-    """Transfer a single backup to AWS S3"""
+def get_s3_client():
+    """Get the shared S3 client, creating it on first use
+
+    The low-level boto3 client is thread-safe, so one client is shared by all
+    transfer workers. Returns None if AWS credentials are not configured.
+    """
+    global _S3_CLIENT
+    with _S3_LOCK:
+        if _S3_CLIENT is None:
+            aws_creds = get_aws_credentials()
+            
+            if not aws_creds.access_key_id or not aws_creds.secret_access_key:
+                logger.error("AWS credentials not configured")
+                return None
+            
+            _S3_CLIENT = boto3.session.Session().client(
+                's3',
+                aws_access_key_id=aws_creds.access_key_id,
+                aws_secret_access_key=aws_creds.secret_access_key,
+                config=Config(
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': 3, 'mode': 'adaptive'}
+                )
+            )
+        return _S3_CLIENT
+
+def get_transfer_config(file_size):
+    """Pick S3 transfer settings for a backup of the given size"""
+    for size_limit, transfer_config in TRANSFER_TIERS:
+        if file_size < size_limit:
+            return transfer_config
+
+def try_get_s3_etag(s3_client, s3_key):
+    """Get an object's ETag like get_s3_etag, but return None on any error
+
+    Backup credentials may be allowed to PUT but not HEAD objects, so a failed
+    lookup must not fail the transfer.
+    """
+    try:
+        return get_s3_etag(s3_client, s3_key)
+    except Exception as e:
+        logger.warning(f"Could not read ETag of {s3_key}: {str(e)}")
+        return None
+
+def get_s3_etag(s3_client, s3_key):
+    """Get the ETag of an object in the S3 bucket, or None if it does not exist"""
+    try:
+        response = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
+        return response["ETag"]
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+def load_transfer_log():
+    """Load completed transfers from the local transfer log, keyed by backup name"""
+    transfers = {}
+    try:
+        with open(TRANSFER_LOG_FILE) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    transfers[entry["backup_name"]] = entry
+                except (ValueError, KeyError):
+                    # Skip a partially written line
+                    continue
+    except FileNotFoundError:
+        pass
+    return transfers
+
+def record_transfer(backup_name, s3_key, etag):
+    """Append a completed transfer to the local transfer log"""
+    entry = {
+        "backup_name": backup_name,
+        "s3_key": s3_key,
+        "etag": etag,
+        "timestamp": datetime.now().isoformat()
+    }
+    try:
+        with _TRANSFER_LOG_LOCK:
+            os.makedirs(os.path.dirname(TRANSFER_LOG_FILE), exist_ok=True)
+            with open(TRANSFER_LOG_FILE, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+    except Exception as e:
+        logger.warning(f"Could not record transfer of {backup_name}: {str(e)}")
+
+def transfer_to_s3(backup_name, s3_client=None, transfer_log=None):
+    """Transfer a single backup to AWS S3, retrying with exponential backoff
+
+    S3 errors are not retried here, since the S3 client already retries them.
+    transfer_log is the result of load_transfer_log() for this run; it is
+    loaded here if not given.
+    """
     if not STORAGE_CLIENT:
         logger.error("Replit Object Storage client not available")
         return False
     
-    try:
-        # Get AWS credentials
-        aws_creds = get_aws_credentials()
-        
-        if not aws_creds["aws_access_key_id"] or not aws_creds["aws_secret_access_key"]:
-            logger.error("AWS credentials not configured")
+    # Use the shared S3 client unless one was passed in
+    if s3_client is None:
+        s3_client = get_s3_client()
+        if s3_client is None:
             return False
+    
+    # Just use the filename part for S3
+    s3_key = backup_name.split('/')[-1]
+    
+    if transfer_log is None:
+        transfer_log = load_transfer_log()
+    logged = transfer_log.get(backup_name)
+    
+    for attempt in range(1, TRANSFER_MAX_ATTEMPTS + 1):
+        try:
+            # Skip backups a previous run already transferred
+            if logged and logged["etag"] and logged["s3_key"] == s3_key and try_get_s3_etag(s3_client, s3_key) == logged["etag"]:
+                logger.info(f"Backup {backup_name} already transferred to S3, skipping")
+                return True
+            
+            # Stream the backup through a temporary file rather than holding it in
+            # memory; Replit Object Storage has no S3-compatible server-side copy
+            with tempfile.NamedTemporaryFile(suffix=".sql.gz") as temp_file:
+                # Download the backup from Replit Object Storage
+                STORAGE_CLIENT.download_to_filename(backup_name, temp_file.name)
+                file_size = os.path.getsize(temp_file.name)
+                
+                # Upload to S3, multipart only for large backups
+                s3_client.upload_fileobj(
+                    temp_file,
+                    S3_BUCKET_NAME,
+                    s3_key,
+                    Config=get_transfer_config(file_size)
+                )
+            
+            record_transfer(backup_name, s3_key, try_get_s3_etag(s3_client, s3_key))
+            logger.info(f"Successfully transferred {backup_name} to S3 bucket {S3_BUCKET_NAME}")
+            return True
         
-        # Download the backup from Replit Object Storage
-        backup_data = STORAGE_CLIENT.download_as_bytes(backup_name)
-        
-        # Initialize S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_creds["aws_access_key_id"],
-            aws_secret_access_key=aws_creds["aws_secret_access_key"]
-        )
-        
-        # Just use the filename part for S3
-        s3_key = backup_name.split('/')[-1]
-        
-        # Upload to S3
-        s3_client.upload_fileobj(
-            io.BytesIO(backup_data),
-            S3_BUCKET_NAME,
-            s3_key
-        )
+        except S3_RETRIED_ERRORS as e:
+            logger.error(f"Error transferring backup {backup_name} to S3: {str(e)}")
+            return False
         
-        logger.info(f"Successfully transferred {backup_name} to S3 bucket {S3_BUCKET_NAME}")
-        return True
-    
-    except Exception as e:
-        logger.error(f"Error transferring backup to S3: {str(e)}")
-        return False
+        except Exception as e:
+            if attempt == TRANSFER_MAX_ATTEMPTS:
+                logger.error(f"Error transferring backup {backup_name} to S3 after {attempt} attempts: {str(e)}")
+                return False
+            
+            # Full-jitter exponential backoff between attempts
+            wait = random.uniform(0, min(TRANSFER_RETRY_MAX_WAIT, 2 ** attempt))
+            logger.warning(f"Error transferring backup {backup_name} to S3 (attempt {attempt}), retrying in {wait:.1f}s: {str(e)}")
+            time.sleep(wait)
 
 def perform_offsite_backup():
     """Main function to transfer recent backups to offsite storage"""
     logger.info("Starting offsite backup transfer")
     
+    # Fail once up front rather than once per backup
+    if not S3_BUCKET_NAME:
+        logger.error("S3 bucket not configured (REPLIT_AWS_S3_BUCKET secret not set)")
+        return False
+    
     # Get recent backups
     recent_backups = list_recent_backups(days=7)
     logger.info(f"Found {len(recent_backups)} recent backups to transfer")
@@ -115,11 +295,29 @@ def perform_offsite_backup():
         logger.warning("No recent backups found to transfer")
         return False
     
-    # Transfer each backup
+    # Share one S3 client between the transfer workers
+    s3_client = get_s3_client()
+    if s3_client is None:
+        return False
+    
+    # Read the transfer log once for the whole run
+    transfer_log = load_transfer_log()
+    
     success_count = 0
-    for backup in recent_backups:
-        if transfer_to_s3(backup):
-            success_count += 1
+    if len(recent_backups) > PROCESS_POOL_THRESHOLD:
+        # Large catch-up batches also spend CPU on TLS, so spread them over
+        # processes; each worker process builds its own S3 client
+        processes = min(PROCESS_POOL_MAX_WORKERS, os.cpu_count() or 1)
+        logger.info(f"Transferring {len(recent_backups)} backups with {processes} processes")
+        with multiprocessing.get_context("spawn").Pool(processes=processes) as pool:
+            success_count = sum(pool.map(functools.partial(transfer_to_s3, transfer_log=transfer_log), recent_backups))
+    else:
+        # Transfer backups concurrently; each transfer is network-bound
+        with ThreadPoolExecutor(max_workers=TRANSFER_MAX_WORKERS) as executor:
+            futures = [executor.submit(transfer_to_s3, backup, s3_client, transfer_log) for backup in recent_backups]
+            for future in as_completed(futures):
+                if future.result():
+                    success_count += 1
     
     logger.info(f"Transferred {success_count} out of {len(recent_backups)} backups to S3")
     return success_count > 0
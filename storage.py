@@ -1,11 +1,19 @@
 import os
-import io
-import uuid
+import re
+import secrets
+import shutil
+import hashlib
+import tempfile
 import logging
+import threading
 import mimetypes
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import has_request_context, request
 from urllib.parse import urlparse, quote
 from pathlib import Path
+from collections import OrderedDict
 from replit.object_storage import Client
 
 # Initialize logger
@@ -26,42 +34,112 @@ def get_replit_client():
 # Global Replit Object Storage client
 STORAGE_CLIENT = get_replit_client()
 
-# Ensure local media directory exists (as fallback)
+# Extension kept on stored filenames
+FILE_EXTENSION_PATTERN = re.compile(r'\.[A-Za-z0-9]{1,8}$')
+
+# Public base URL of the deployment (first of Replit's REPLIT_DOMAINS),
+# resolved once at import for file URLs built outside a request
+_replit_domains = os.environ.get("REPLIT_DOMAINS", "").strip()
+PUBLIC_BASE_URL = f"https://{_replit_domains.split(',')[0]}" if _replit_domains else None
+
+# Read size when copying downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Local files larger than this are evicted from the page cache after writing
+PAGE_CACHE_DROP_THRESHOLD = 4 * 1024 * 1024
+
+# (connect, read) timeouts in seconds for media downloads
+DOWNLOAD_TIMEOUT = (5, 60)
+
+# Shared HTTP session for media downloads, so repeated fetches from
+# Telegram's file servers reuse pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+# File extensions recognised for each media type; anything else is a document
+ALLOWED_MEDIA_TYPES = {
+    'image': ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'),
+    'video': ('.mp4', '.mov', '.avi', '.webm', '.mkv'),
+    'audio': ('.mp3', '.wav', '.ogg', '.m4a', '.flac'),
+}
+
+# Inverted once at import so get_media_type is a single lookup
+EXTENSION_MEDIA_TYPES = {
+    ext: media_type
+    for media_type, extensions in ALLOWED_MEDIA_TYPES.items()
+    for ext in extensions
+}
+
+# Recently stored files keyed by a hash of their source URL, with the
+# (ETag, Content-Length) seen at the time, so re-posted media that has not
+# changed is copied within storage instead of downloaded again (per process,
+# not persisted)
+STORED_FILES_CACHE_SIZE = 1024
+_stored_files = OrderedDict()
+_stored_files_lock = threading.Lock()
+
+def _url_key(url):
+    """Hash a source URL into a compact cache key"""
+    return hashlib.blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
+
+def _signature_from_headers(headers):
+    """Get (ETag, Content-Length) from response headers, or None if neither is set"""
+    etag = headers.get('ETag')
+    size = headers.get('Content-Length')
+    if etag or size:
+        return (etag, size)
+    return None
+
+def _get_content_signature(url):
+    """Get (ETag, Content-Length) for a URL with a HEAD request, or None"""
+    try:
+        response = _SESSION.head(url, allow_redirects=True, timeout=10)
+        response.raise_for_status()
+        return _signature_from_headers(response.headers)
+    except Exception as e:
+        logger.debug(f"HEAD request failed for {url}: {str(e)}")
+    return None
+
+def _copy_stored_file(stored_path, unique_filename):
+    """Copy a stored file to a new name in the same storage, returning its stored path"""
+    if stored_path.startswith('replit://'):
+        object_name = f"media/{unique_filename}"
+        STORAGE_CLIENT.copy(stored_path[9:], object_name)
+        return f"replit://{object_name}"
+    
+    shutil.copyfile(_CWD / stored_path, MEDIA_DIR / unique_filename)
+    return f"media/{unique_filename}"
+
+# Local media directory (fallback storage), resolved and created once at import
+_CWD = Path.cwd()
+MEDIA_DIR = _CWD / 'media'
+MEDIA_DIR.mkdir(exist_ok=True)
+
 def ensure_media_dir():
-    """Ensure the media directory exists"""
-    media_dir = os.path.join(os.getcwd(), 'media')
-    os.makedirs(media_dir, exist_ok=True)
-    return media_dir
+    """Get the local media directory (created at import)"""
+    return MEDIA_DIR
+
+def get_file_extension(filename):
+    """Get the lowercased extension of a filename, or '' if it has none"""
+    match = FILE_EXTENSION_PATTERN.search(filename or '')
+    return match.group(0).lower() if match else ''
 
 def get_media_type(filename):
     """Determine media type from filename extension"""
-    extension = os.path.splitext(filename)[1].lower()
-    
-    if extension in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp']:
-        return 'image'
-    elif extension in ['.mp4', '.mov', '.avi', '.webm', '.mkv']:
-        return 'video'
-    elif extension in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']:
-        return 'audio'
-    else:
-        return 'document'
+    return EXTENSION_MEDIA_TYPES.get(get_file_extension(filename), 'document')
 
-# This function is duplicated - removed
+def _random_filename(extension):
+    """Random filename with the given extension ('.bin' if empty)"""
+    # 128 random bits, as many as the uuid4 names used before
+    return f"{secrets.token_hex(16)}{extension or '.bin'}"
 
 def generate_unique_filename(original_filename):
-    """Generate a unique filename with UUID to avoid collisions"""
-    if not original_filename:
-        # Default extension if none provided
-        original_filename = "file.bin"
-        
-    # Extract the file extension
-    _, extension = os.path.splitext(original_filename)
-    if not extension:
-        extension = ".bin"  # Default extension if none found
-    
-    # Create a unique filename with UUID and the original extension
-    unique_filename = f"{uuid.uuid4().hex}{extension.lower()}"
-    return unique_filename
+    """Generate a random unique filename, keeping the original extension"""
+    return _random_filename(get_file_extension(original_filename))
 
 def save_file_from_url(url, original_filename=None):
     """
@@ -80,14 +158,47 @@ def save_file_from_url(url, original_filename=None):
             parsed_url = urlparse(url)
             original_filename = os.path.basename(parsed_url.path)
         
-        # Generate unique filename
-        unique_filename = generate_unique_filename(original_filename)
+        # If this URL was saved before and is unchanged, copy the stored file
+        # instead of downloading it again. Each message gets its own copy, so
+        # deleting one message's file never breaks another's. Only URLs
+        # already in the cache pay for the HEAD request.
+        url_key = _url_key(url)
+        with _stored_files_lock:
+            cached = _stored_files.get(url_key)
+        if cached and _get_content_signature(url) == cached[0]:
+            try:
+                cached_metadata = cached[1]
+                unique_filename = _random_filename(get_file_extension(cached_metadata['filename']))
+                stored_path = _copy_stored_file(cached_metadata['stored_path'], unique_filename)
+                logger.info(f"File from {url} copied from {cached_metadata['stored_path']} to {stored_path}")
+                with _stored_files_lock:
+                    if url_key in _stored_files:
+                        _stored_files.move_to_end(url_key)
+                return dict(
+                    cached_metadata,
+                    stored_path=stored_path,
+                    filename=unique_filename,
+                    original_filename=original_filename
+                )
+            except Exception as e:
+                logger.warning(f"Could not copy stored file for {url}, downloading again: {str(e)}")
+        
+        # Generate unique filename, sharing the extension with the media type check
+        extension = get_file_extension(original_filename)
+        unique_filename = _random_filename(extension)
         
         # Download file from URL
         logger.info(f"Downloading file from {url}")
-        response = requests.get(url, stream=True)
+        response = _SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
         response.raise_for_status()
         
+        # Remember what was downloaded, to recognise the same file next time
+        signature = _signature_from_headers(response.headers)
+        
+        # Read the body straight from the raw stream, still undoing any
+        # Content-Encoding the way iter_content would
+        response.raw.decode_content = True
+        
         # Get MIME type
         content_type = response.headers.get('Content-Type')
         if not content_type:
@@ -106,24 +217,22 @@ def save_file_from_url(url, original_filename=None):
             media_type = 'audio'
         else:
             # Try to determine from filename
-            media_type = get_media_type(original_filename)
-        
-        # Read file data into memory
-        file_data = io.BytesIO()
-        for chunk in response.iter_content(chunk_size=8192):
-            file_data.write(chunk)
-        
-        file_data.seek(0)
-        file_size = file_data.getbuffer().nbytes
+            media_type = EXTENSION_MEDIA_TYPES.get(extension, 'document')
         
         # Define object key for storage
         object_name = f"media/{unique_filename}"
         
         # Check if we can use Replit Object Storage
         if STORAGE_CLIENT:
-            # Upload to Replit Object Storage
-            file_data.seek(0)
-            STORAGE_CLIENT.upload_from_bytes(object_name, file_data.getvalue())
+            # Stream the download into a temporary file and upload from disk,
+            # so only one chunk of the file is held in memory at a time
+            with tempfile.NamedTemporaryFile() as temp_file:
+                shutil.copyfileobj(response.raw, temp_file, length=DOWNLOAD_CHUNK_SIZE)
+                file_size = temp_file.tell()
+                temp_file.flush()
+                
+                # Upload to Replit Object Storage
+                STORAGE_CLIENT.upload_from_filename(object_name, temp_file.name)
             
             logger.info(f"File uploaded to Replit Object Storage: {object_name}, size: {file_size} bytes, type: {media_type}")
             
@@ -131,21 +240,29 @@ def save_file_from_url(url, original_filename=None):
             stored_path = f"replit://{object_name}"
         else:
             # Fallback to local storage
-            media_dir = ensure_media_dir()
-            file_path = os.path.join(media_dir, unique_filename)
-            relative_path = os.path.join('media', unique_filename)
+            file_path = MEDIA_DIR / unique_filename
+            # Always a forward slash, as the path doubles as the file's URL path
+            relative_path = f"media/{unique_filename}"
             
+            # Stream the download straight to its destination
             with open(file_path, 'wb') as f:
-                file_data.seek(0)
-                f.write(file_data.read())
+                shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+                file_size = f.tell()
+                
+                # Large media is rarely read back soon, so drop it from the
+                # page cache once it is on disk
+                if file_size > PAGE_CACHE_DROP_THRESHOLD and hasattr(os, 'posix_fadvise'):
+                    f.flush()
+                    os.fdatasync(f.fileno())
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
             
             logger.info(f"File saved to local storage: {file_path}, size: {file_size} bytes, type: {media_type}")
             
             # Store local path
             stored_path = relative_path
         
-        # Return file metadata
-        return {
+        # File metadata
+        file_metadata = {
             'stored_path': stored_path,
             'size': file_size,
             'media_type': media_type,
@@ -154,6 +271,16 @@ def save_file_from_url(url, original_filename=None):
             'filename': unique_filename
         }
         
+        # Remember the stored copy for later saves of the same URL
+        if signature:
+            with _stored_files_lock:
+                _stored_files[url_key] = (signature, file_metadata)
+                _stored_files.move_to_end(url_key)
+                if len(_stored_files) > STORED_FILES_CACHE_SIZE:
+                    _stored_files.popitem(last=False)
+        
+        return dict(file_metadata)
+        
     except Exception as e:
         logger.error(f"Error saving file from URL {url}: {str(e)}")
         return None
@@ -173,36 +300,23 @@ def get_file_url(stored_path):
     
     # Check if it's a Replit Object Storage path
     if stored_path.startswith('replit://'):
-        # Extract the object name
-        object_name = stored_path[9:]  # Remove 'replit://' prefix
-        
-        try:
-            # For Notion integration, we need a fully qualified URL
-            # First try to get the current host from Flask request context
-            try:
-                from flask import request
-                base_url = request.host_url.rstrip('/')
-                object_name_encoded = quote(object_name)
-                return f"{base_url}/object-storage/{object_name_encoded}"
-            except Exception as e:
-                # If we're outside of a request context, use a direct relative URL
-                # (This won't work for Notion but will work for local display)
-                logger.warning(f"Unable to generate absolute URL: {str(e)}")
-                object_name_encoded = quote(object_name)
-                return f"/object-storage/{object_name_encoded}"
-        except Exception as e:
-            logger.error(f"Error creating URL for object {object_name}: {str(e)}")
-            return None
+        # Served by the app from the object name (without 'replit://' prefix)
+        url_path = f"/object-storage/{quote(stored_path[9:])}"
     else:
-        # Local path, generate URL
-        try:
-            from flask import request
-            base_url = request.host_url.rstrip('/')
-            return f"{base_url}/{stored_path}"
-        except Exception as e:
-            # Fallback to just the path
-            logger.warning(f"Unable to generate absolute URL for local file: {str(e)}")
-            return f"/{stored_path}"
+        # Local path
+        url_path = f"/{stored_path}"
+    
+    # For Notion integration we need a fully qualified URL: use the current
+    # request's host, or the deployment's public domain outside a request
+    if has_request_context():
+        return f"{request.host_url.rstrip('/')}{url_path}"
+    if PUBLIC_BASE_URL:
+        return f"{PUBLIC_BASE_URL}{url_path}"
+    
+    # Fall back to a relative URL
+    # (this won't work for Notion but will work for local display)
+    logger.debug(f"No request context or public domain, using relative URL for {stored_path}")
+    return url_path
 
 def delete_file(stored_path):
     """
@@ -215,6 +329,12 @@ def delete_file(stored_path):
         bool: True if successful, False otherwise
     """
     try:
+        # Forget any cached copy so the next save of its URL re-downloads it
+        with _stored_files_lock:
+            for url_key, (_, metadata) in list(_stored_files.items()):
+                if metadata['stored_path'] == stored_path:
+                    del _stored_files[url_key]
+        
         # Check if it's a Replit Object Storage path
         if stored_path and stored_path.startswith('replit://'):
             # Extract the object name
@@ -234,16 +354,18 @@ def delete_file(stored_path):
                 return False
         else:
             # Local storage path
-            full_path = os.path.join(os.getcwd(), stored_path)
+            full_path = _CWD / stored_path
             
-            # Check if file exists
-            if os.path.exists(full_path):
+            try:
                 os.remove(full_path)
                 logger.info(f"Deleted file {full_path}")
                 return True
-            else:
+            except FileNotFoundError:
                 logger.warning(f"File not found: {full_path}")
                 return False
+            except OSError as e:
+                logger.error(f"Error deleting file {full_path}: {str(e)}")
+                return False
     except Exception as e:
         logger.error(f"Error deleting file {stored_path}: {str(e)}")
         return False
\ No newline at end of file
@@ -1,22 +1,41 @@
 import os
 import json
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from flask import jsonify
 import requests
+from sqlalchemy import and_, select, update
 from app import db
 from models import TelegramMessage, Setting
 # Import the module that causes the "No module named 'replit.object_storage'" error
 # when handle_telegram_update is called
 import storage  # This pre-loads the storage module with all its dependencies
+from storage import save_file_from_url
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
+# UTC timezone for message timestamps
+_UTC = timezone.utc
+
+# Telegram bot token, read once from Replit Secrets at import
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+
+# Worker threads for media downloads, which run off the webhook request
+IO_POOL_MAX_WORKERS = 8
+_IO_POOL = ThreadPoolExecutor(max_workers=IO_POOL_MAX_WORKERS, thread_name_prefix="telegram-media")
+
+# Messages whose media download has not finished yet; the Notion sync skips them
+MEDIA_PENDING = and_(TelegramMessage.media_file_id.isnot(None), TelegramMessage.media_stored_path.is_(None))
+
+# Downloads still pending this long after their message (e.g. lost to a worker
+# restart) are retried once by the sync, then marked failed
+MEDIA_RETRY_AFTER = timedelta(minutes=10)
+
 def get_telegram_token():
     """Get Telegram bot token from environment secrets"""
-    import os
-    return os.environ.get("TELEGRAM_BOT_TOKEN")
+    return TELEGRAM_BOT_TOKEN
 
 def setup_telegram_webhook(token, webhook_url):
     """Set up Telegram webhook URL"""
@@ -52,8 +71,169 @@ def get_file_info(token, file_id):
         logger.error(f"Error getting file info: {str(e)}")
         return None
 
-def handle_telegram_update(update):
-    """Process incoming Telegram update from webhook"""
+def save_message(new_message):
+    """Save a new message in its own transaction
+
+    Returns the saved row's id, or None if it could not be saved.
+    """
+    try:
+        db.session.add(new_message)
+        # Flush to get the id; reading it after the commit would reload the row
+        db.session.flush()
+        message_pk = new_message.id
+        db.session.commit()
+        return message_pk
+    except Exception as e:
+        logger.error(f"Error saving message {new_message.message_id}: {str(e)}")
+        db.session.rollback()
+        return None
+
+def _photo_file_size(photo):
+    """Sort key for photo sizes (file_size may be missing)"""
+    return photo.get('file_size', 0)
+
+def _handle_photo(message):
+    """Get the largest photo size and its caption"""
+    photos = message.get('photo', [])
+    if not photos:
+        return 'image', None, ""
+    
+    # Get the largest photo; file_size is optional, so a plain itemgetter won't do
+    photo = max(photos, key=_photo_file_size)
+    return 'image', photo.get('file_id'), message.get('caption', '')
+
+def _handle_document(message):
+    """Get a document, typed by its MIME type, and its caption"""
+    document = message.get('document', {})
+    mime_type = document.get('mime_type', '')
+    
+    # Set media type based on MIME type
+    if mime_type.startswith('image/'):
+        media_type = 'image'
+    elif mime_type.startswith('video/'):
+        media_type = 'video'
+    elif mime_type.startswith('audio/'):
+        media_type = 'audio'
+    else:
+        media_type = 'document'
+    
+    return media_type, document.get('file_id'), message.get('caption', '')
+
+def _handle_video(message):
+    """Get a video and its caption"""
+    return 'video', message['video'].get('file_id'), message.get('caption', '')
+
+def _handle_audio(message):
+    """Get an audio file and its caption"""
+    return 'audio', message['audio'].get('file_id'), message.get('caption', '')
+
+def _handle_voice(message):
+    """Get a voice note and its caption"""
+    return 'audio', message['voice'].get('file_id'), message.get('caption', '')
+
+# Media handlers by message field, in order of precedence; each returns
+# (media_type, media_file_id, text)
+_MEDIA_HANDLERS = {
+    'photo': _handle_photo,
+    'document': _handle_document,
+    'video': _handle_video,
+    'audio': _handle_audio,
+    'voice': _handle_voice,
+}
+
+def save_message_media(message_pk, token, media_file_id):
+    """Download a saved message's media to storage and record it on the message row
+
+    Returns True if the media was saved.
+    """
+    from app import app
+    
+    try:
+        # Get file info from Telegram
+        file_info = get_file_info(token, media_file_id)
+        
+        if not file_info or 'file_path' not in file_info:
+            logger.error(f"Failed to get file info from Telegram for file ID: {media_file_id}")
+            return False
+        
+        # Get file URL from Telegram
+        file_path = file_info.get('file_path')
+        file_url = f"https://api.telegram.org/file/bot{token}/{file_path}"
+        
+        # Determine original filename
+        original_filename = os.path.basename(file_path)
+        
+        # Save file to storage
+        media_data = save_file_from_url(file_url, original_filename)
+        
+        if not media_data:
+            logger.error(f"Failed to save media file from URL: {file_url}")
+            return False
+        
+        # Update the message row with media data
+        with app.app_context():
+            try:
+                db.session.execute(
+                    update(TelegramMessage)
+                    .where(TelegramMessage.id == message_pk)
+                    .values(
+                        media_type=media_data.get('media_type'),
+                        media_original_url=file_url,
+                        media_stored_path=media_data.get('stored_path'),
+                        media_size=media_data.get('size'),
+                        media_filename=original_filename,
+                        media_content_type=media_data.get('content_type')
+                    )
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        
+        logger.info(f"Saved media file: {media_data.get('stored_path')}")
+        return True
+    except Exception as e:
+        logger.error(f"Error saving media for message row {message_pk}: {str(e)}")
+        return False
+
+def mark_media_failed(message_pk):
+    """Give up on a message's media so it syncs without it
+
+    Clears media_file_id, which takes the row out of MEDIA_PENDING; the file
+    id is still in the stored message data.
+    """
+    db.session.execute(
+        update(TelegramMessage)
+        .where(TelegramMessage.id == message_pk)
+        .values(media_file_id=None)
+    )
+    db.session.commit()
+
+def retry_pending_media():
+    """Retry media downloads pending for longer than MEDIA_RETRY_AFTER
+
+    Each download gets one more try here; if it fails again the media is
+    marked failed. Must run in an app context.
+    """
+    cutoff = datetime.utcnow() - MEDIA_RETRY_AFTER
+    stalled = db.session.execute(
+        select(TelegramMessage.id, TelegramMessage.media_file_id)
+        .where(MEDIA_PENDING, TelegramMessage.timestamp < cutoff)
+    ).all()
+    
+    token = get_telegram_token()
+    for message_pk, media_file_id in stalled:
+        logger.warning(f"Retrying media download for message row {message_pk}")
+        if not token or not save_message_media(message_pk, token, media_file_id):
+            logger.error(f"Giving up on media for message row {message_pk}")
+            mark_media_failed(message_pk)
+
+def handle_telegram_update(update, raw_body=None):
+    """Process incoming Telegram update from webhook
+
+    raw_body is the update's JSON body as received; when given it is stored
+    as the message data instead of re-serializing the parsed message.
+    """
     try:
         # Check if update contains a message
         if 'message' not in update:
@@ -86,55 +266,12 @@ def handle_telegram_update(update):
         if 'text' in message:
             text = message.get('text', '')
         
-        # Check for photos
-        elif 'photo' in message:
-            has_media = True
-            media_type = 'image'
-            # Get largest photo
-            photos = message.get('photo', [])
-            if photos:
-                # Sort by file size (largest last)
-                photos.sort(key=lambda x: x.get('file_size', 0))
-                photo = photos[-1]  # Get the largest photo
-                media_file_id = photo.get('file_id')
-                # Check if there's a caption
-                text = message.get('caption', '')
-        
-        # Check for documents (files)
-        elif 'document' in message:
-            has_media = True
-            document = message.get('document', {})
-            media_file_id = document.get('file_id')
-            mime_type = document.get('mime_type', '')
-            
-            # Set media type based on MIME type
-            if mime_type.startswith('image/'):
-                media_type = 'image'
-            elif mime_type.startswith('video/'):
-                media_type = 'video'
-            elif mime_type.startswith('audio/'):
-                media_type = 'audio'
-            else:
-                media_type = 'document'
-                
-            # Check if there's a caption
-            text = message.get('caption', '')
-        
-        # Check for videos
-        elif 'video' in message:
-            has_media = True
-            media_type = 'video'
-            video = message.get('video', {})
-            media_file_id = video.get('file_id')
-            text = message.get('caption', '')
-        
-        # Check for audio
-        elif 'audio' in message or 'voice' in message:
-            has_media = True
-            media_type = 'audio'
-            audio = message.get('audio', message.get('voice', {}))
-            media_file_id = audio.get('file_id')
-            text = message.get('caption', '')
+        # Otherwise use the handler for the first media field present
+        else:
+            media_key = next((key for key in _MEDIA_HANDLERS if key in message), None)
+            if media_key:
+                has_media = True
+                media_type, media_file_id, text = _MEDIA_HANDLERS[media_key](message)
         
         # If no text and no media, skip this message
         if not text and not has_media:
@@ -142,7 +279,8 @@ def handle_telegram_update(update):
             return jsonify({"status": "ok", "message": "No content in message"})
             
         date = message.get('date', 0)
-        timestamp = datetime.fromtimestamp(date)
+        # Telegram dates are Unix seconds; stored as naive UTC like the model defaults
+        timestamp = datetime.fromtimestamp(date, _UTC).replace(tzinfo=None)
         
         # Create new message record
         new_message = TelegramMessage(
@@ -158,52 +296,35 @@ def handle_telegram_update(update):
             synced=False
         )
         
+        # Store full message data, as received when the raw body is available
+        if raw_body:
+            new_message.set_message_data_raw(raw_body)
+        else:
+            new_message.set_message_data(message)
+        
         # Handle media if present
+        token = None
         if has_media and media_file_id:
-            from storage import save_file_from_url
-            
             # Get the token
             token = get_telegram_token()
             if not token:
                 logger.error("No Telegram token found in settings")
                 return jsonify({"status": "error", "message": "No Telegram token configured"})
             
-            # Get file info from Telegram
-            file_info = get_file_info(token, media_file_id)
-            
-            if file_info and 'file_path' in file_info:
-                # Get file URL from Telegram
-                file_path = file_info.get('file_path')
-                file_url = f"https://api.telegram.org/file/bot{token}/{file_path}"
-                
-                # Determine original filename
-                original_filename = os.path.basename(file_path)
-                
-                # Save file to storage
-                media_data = save_file_from_url(file_url, original_filename)
-                
-                if media_data:
-                    # Update message with media data
-                    new_message.media_type = media_data.get('media_type')
-                    new_message.media_file_id = media_file_id
-                    new_message.media_original_url = file_url
-                    new_message.media_stored_path = media_data.get('stored_path')
-                    new_message.media_size = media_data.get('size')
-                    new_message.media_filename = original_filename
-                    new_message.media_content_type = media_data.get('content_type')
-                    
-                    logger.info(f"Saved media file: {media_data.get('stored_path')}")
-                else:
-                    logger.error(f"Failed to save media file from URL: {file_url}")
-            else:
-                logger.error(f"Failed to get file info from Telegram for file ID: {media_file_id}")
-        
-        # Store full message data
-        new_message.set_message_data(message)
-        
-        # Save to database
-        db.session.add(new_message)
-        db.session.commit()
+            # Saved with the message; the stored file is filled in later
+            new_message.media_type = media_type
+            new_message.media_file_id = media_file_id
+        
+        # Committed before the update is acknowledged; an error response
+        # makes Telegram redeliver it
+        message_pk = save_message(new_message)
+        if message_pk is None:
+            return jsonify({"status": "error", "message": "Failed to save message"}), 500
+        
+        if token:
+            # Download the media in the background so the webhook is
+            # acknowledged without waiting on Telegram's file servers
+            _IO_POOL.submit(save_message_media, message_pk, token, media_file_id)
         
         if has_media:
             logger.info(f"Saved message with {media_type} from {username} in {chat_title}")
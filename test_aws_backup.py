@@ -4,10 +4,12 @@ Test AWS S3 Offsite Backup Functionality
 This script tests the AWS S3 backup functionality specifically.
 """
 import os
-import io
 import sys
+import hashlib
 import logging
+import tempfile
 import boto3
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime
 
 # Configure logging
@@ -15,6 +17,15 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('aws_backup_test')
 
+# Transfer settings for the test upload and download: multipart in 8 MiB
+# parts, several parts in flight at once
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+    use_threads=True
+)
+
 def get_aws_credentials():
     """Get AWS credentials from environment variables/secrets"""
     aws_access_key = os.environ.get("REPLIT_AWS_ACCESS_KEY_ID", "")
@@ -71,7 +82,7 @@ def test_aws_s3_connection():
             if objects:
                 logger.info("Sample objects:")
                 for obj in objects[:5]:  # Show first 5 objects
-                    logger.info(f" - {obj['Key']} ({obj['Size']} bytes)")
+                    logger.info(" - %s (%d bytes)", obj['Key'], obj['Size'])
             
             return True
         except Exception as e:
@@ -101,34 +112,33 @@ def test_aws_s3_offsite_backup():
         # Create test data
         test_data = f"Test backup data created at {datetime.now().isoformat()}".encode('utf-8')
         test_key = f"test/test_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        expected_digest = hashlib.sha256(test_data).digest()
         bucket_name = aws_creds["bucket_name"]
         
-        # Upload test data to S3
-        logger.info(f"Uploading test data to S3 bucket '{bucket_name}', key: '{test_key}'")
-        s3_client.upload_fileobj(
-            io.BytesIO(test_data),
-            bucket_name,
-            test_key
-        )
-        logger.info("✅ Upload successful")
+        # Upload from a temporary file, as real backups are
+        with tempfile.NamedTemporaryFile() as upload_file:
+            upload_file.write(test_data)
+            upload_file.flush()
+            
+            # Upload test data to S3
+            logger.info(f"Uploading test data to S3 bucket '{bucket_name}', key: '{test_key}'")
+            s3_client.upload_file(upload_file.name, bucket_name, test_key, Config=TRANSFER_CONFIG)
+            logger.info("✅ Upload successful")
         
         # Verify file exists
         logger.info(f"Verifying file exists in S3")
         response = s3_client.head_object(Bucket=bucket_name, Key=test_key)
         logger.info(f"✅ File verified in S3, size: {response['ContentLength']} bytes")
         
-        # Download the file to verify content
+        # Stream the file back through SHA-256 to verify content without
+        # holding a second copy in memory
         logger.info(f"Downloading file to verify content")
-        download_buffer = io.BytesIO()
-        s3_client.download_fileobj(
-            bucket_name,
-            test_key,
-            download_buffer
-        )
-        download_buffer.seek(0)
-        downloaded_data = download_buffer.read()
+        digest = hashlib.sha256()
+        body = s3_client.get_object(Bucket=bucket_name, Key=test_key)['Body']
+        for chunk in body.iter_chunks(1 << 20):
+            digest.update(chunk)
         
-        if downloaded_data == test_data:
+        if digest.digest() == expected_digest:
             logger.info("✅ Downloaded data matches original data")
         else:
             logger.error("❌ Downloaded data does not match original data")
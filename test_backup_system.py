@@ -8,18 +8,18 @@ This script performs a comprehensive test of the backup system:
 4. Attempts a test restore to verify backup integrity
 """
 import os
-import io
 import sys
 import json
 import gzip
 import logging
 import tempfile
-import subprocess
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import boto3
+import google_crc32c
 from storage import STORAGE_CLIENT
 from backup_database import create_db_backup, get_backup_filename
-from offsite_backup import transfer_to_s3
+from offsite_backup import transfer_to_s3, get_transfer_config, get_s3_client
 from backup_restore import download_backup
 
 # Configure logging
@@ -30,6 +30,10 @@ logger = logging.getLogger('backup_test')
 # S3 bucket configuration (read from offsite_backup.py)
 from offsite_backup import S3_BUCKET_NAME
 
+# Leading bytes of a gzip file, and of the plain SQL dumps create_db_backup writes
+GZIP_MAGIC = b"\x1f\x8b"
+SQL_DUMP_HEADER = b"-- Database: "
+
 def get_aws_credentials():
     """Get AWS credentials from environment variables/secrets"""
     return {
@@ -37,6 +41,14 @@ def get_aws_credentials():
         "aws_secret_access_key": os.environ.get("REPLIT_AWS_SECRET_ACCESS_KEY", "")
     }
 
+def file_crc32c(path):
+    """Compute the CRC32C checksum of a file, reading it in 1 MiB chunks"""
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            checksum.update(chunk)
+    return checksum.digest()
+
 def test_create_backup():
     """Test creating a database backup"""
     logger.info("=== TESTING BACKUP CREATION ===")
@@ -49,18 +61,39 @@ def test_create_backup():
         logger.error("❌ Failed to create backup")
         return None
     
-    size_mb = len(backup_data) / (1024 * 1024)
-    logger.info(f"✅ Backup created successfully ({size_mb:.2f} MB)")
+    # Spool the backup to a temporary file that every test reads from, so
+    # no test needs its own in-memory copy
+    backup_file = tempfile.NamedTemporaryFile(suffix=".sql.gz")
+    backup_file.write(backup_data)
+    backup_file.flush()
+    size = backup_file.tell()
+    del backup_data
+    
+    size_mb = size / (1024 * 1024)
+    logger.info("✅ Backup created successfully (%.2f MB)", size_mb)
     
     # Generate a test filename
     test_filename = f"test_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.sql.gz"
     
     return {
-        "backup_data": backup_data,
+        "backup_file": backup_file,
+        "path": backup_file.name,
         "filename": test_filename,
+        "size": size,
         "size_mb": size_mb
     }
 
+@contextmanager
+def backup_context():
+    """Create the test backup, yielding its info (None on failure), and delete
+    the spooled backup file once the tests are done with it"""
+    backup_info = test_create_backup()
+    try:
+        yield backup_info
+    finally:
+        if backup_info:
+            backup_info["backup_file"].close()
+
 def test_replit_storage(backup_info):
     """Test storing backup in Replit Object Storage"""
     logger.info("\n=== TESTING REPLIT OBJECT STORAGE ===")
@@ -69,49 +102,49 @@ def test_replit_storage(backup_info):
         logger.error("❌ Replit Object Storage client not available")
         return False
     
-    if not backup_info or not backup_info.get("backup_data"):
+    if not backup_info or not backup_info.get("backup_file"):
         logger.error("❌ No backup data available to test")
         return False
     
     try:
         # Upload to Replit Object Storage
         object_name = f"backups/test/{backup_info['filename']}"
-        logger.info(f"Uploading to Replit Object Storage: {object_name}")
+        logger.info("Uploading to Replit Object Storage: %s", object_name)
         
-        STORAGE_CLIENT.upload_from_bytes(object_name, backup_info["backup_data"])
-        logger.info(f"✅ Upload successful")
+        STORAGE_CLIENT.upload_from_filename(object_name, backup_info["path"])
+        logger.info("✅ Upload successful")
         
-        # Verify file exists
-        objects = STORAGE_CLIENT.list()
-        if object_name in objects:
-            logger.info(f"✅ Object verified in storage")
+        # Verify file exists (a single lookup rather than listing the bucket)
+        if STORAGE_CLIENT.exists(object_name):
+            logger.info("✅ Object verified in storage")
         else:
-            logger.warning(f"⚠️ Object not found in storage listing")
+            logger.warning("⚠️ Object not found in storage listing")
         
-        # Try to download the file
+        # Try to download the file and verify its content by CRC32C
         try:
-            downloaded_data = STORAGE_CLIENT.download_as_bytes(object_name)
-            download_size = len(downloaded_data) / (1024 * 1024)
-            logger.info(f"✅ Download successful ({download_size:.2f} MB)")
-            
-            if len(downloaded_data) == len(backup_info["backup_data"]):
-                logger.info("✅ Downloaded file size matches original")
-            else:
-                logger.warning(f"⚠️ Size mismatch: Original={backup_info['size_mb']:.2f} MB, Downloaded={download_size:.2f} MB")
+            with tempfile.NamedTemporaryFile() as download_file:
+                STORAGE_CLIENT.download_to_filename(object_name, download_file.name)
+                download_size = os.path.getsize(download_file.name) / (1024 * 1024)
+                logger.info("✅ Download successful (%.2f MB)", download_size)
+                
+                if file_crc32c(download_file.name) == file_crc32c(backup_info["path"]):
+                    logger.info("✅ Downloaded file checksum matches original")
+                else:
+                    logger.warning("⚠️ Checksum mismatch: Original=%.2f MB, Downloaded=%.2f MB", backup_info['size_mb'], download_size)
         except Exception as e:
-            logger.error(f"❌ Error downloading file: {str(e)}")
+            logger.error("❌ Error downloading file: %s", e)
         
         # Clean up
         try:
             STORAGE_CLIENT.delete(object_name)
-            logger.info(f"✅ Test object deleted")
+            logger.info("✅ Test object deleted")
         except Exception as e:
-            logger.error(f"❌ Error deleting test object: {str(e)}")
+            logger.error("❌ Error deleting test object: %s", e)
         
         return True
     
     except Exception as e:
-        logger.error(f"❌ Error testing Replit Object Storage: {str(e)}")
+        logger.error("❌ Error testing Replit Object Storage: %s", e)
         return False
 
 def test_aws_s3(backup_info):
@@ -124,7 +157,7 @@ def test_aws_s3(backup_info):
         logger.error("❌ AWS credentials not configured")
         return False
     
-    if not backup_info or not backup_info.get("backup_data"):
+    if not backup_info or not backup_info.get("backup_file"):
         logger.error("❌ No backup data available to test")
         return False
     
@@ -134,7 +167,7 @@ def test_aws_s3(backup_info):
     # Check if bucket name is valid
     import re
     if bucket_name and not re.match(r'^[a-zA-Z0-9.\-_]{1,255}$', bucket_name):
-        logger.warning(f"⚠️ S3 bucket name '{bucket_name}' appears to be invalid")
+        logger.warning("⚠️ S3 bucket name '%s' appears to be invalid", bucket_name)
         logger.info("Skipping S3 bucket tests, but testing AWS credentials and S3 client setup")
         bucket_name = None
     elif not bucket_name:
@@ -142,118 +175,112 @@ def test_aws_s3(backup_info):
         logger.info("Skipping S3 bucket tests, but testing AWS credentials and S3 client setup")
         bucket_name = None
     
-    object_name = None
     try:
-        # Initialize S3 client first to verify AWS credentials
-        logger.info("Initializing S3 client to verify AWS credentials")
-        try:
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=aws_creds["aws_access_key_id"],
-                aws_secret_access_key=aws_creds["aws_secret_access_key"]
-            )
-            logger.info("✅ AWS credentials valid - S3 client initialized successfully")
-        except Exception as e:
-            logger.error(f"❌ Failed to initialize S3 client: {str(e)}")
-            return False
-
-        # If no bucket name, just verify credentials and return
-        if bucket_name is None:
-            logger.info("✅ AWS credentials verified (S3 bucket tests skipped)")
-            return True
-
-        # Upload to temporary location in Replit Object Storage first
-        object_name = f"backups/test/{backup_info['filename']}"
-        logger.info(f"Creating temporary object for S3 test: {object_name}")
-        
-        if not STORAGE_CLIENT:
-            logger.error("❌ Replit Object Storage client not available")
-            return False
-        
-        STORAGE_CLIENT.upload_from_bytes(object_name, backup_info["backup_data"])
-        
-        # Test transferring to S3
-        logger.info(f"Testing transfer to S3 bucket: {bucket_name}")
-        
-        # Check if bucket exists
-        try:
-            s3_client.head_bucket(Bucket=bucket_name)
-            logger.info(f"✅ S3 bucket {bucket_name} exists and is accessible")
-        except Exception as e:
-            logger.error(f"❌ S3 bucket error: {str(e)}")
-            # Clean up
-            if object_name:
-                STORAGE_CLIENT.delete(object_name)
-            return False
-        
-        # Upload to S3
-        try:
-            # Direct upload from memory
-            s3_key = f"test/{backup_info['filename']}"
-            s3_client.upload_fileobj(
-                io.BytesIO(backup_info["backup_data"]),
-                bucket_name,
-                s3_key
-            )
-            logger.info(f"✅ Direct upload to S3 successful")
+        # Staging objects are deleted however the test exits
+        with ExitStack() as cleanup:
+            # Initialize S3 client first to verify AWS credentials
+            logger.info("Initializing S3 client to verify AWS credentials")
+            try:
+                # Shared, pooled client from offsite_backup, as used for real transfers
+                s3_client = get_s3_client()
+                if s3_client is None:
+                    logger.error("❌ Failed to initialize S3 client")
+                    return False
+                logger.info("✅ AWS credentials valid - S3 client initialized successfully")
+            except Exception as e:
+                logger.error("❌ Failed to initialize S3 client: %s", e)
+                return False
             
-            # Verify file exists in S3
+            # If no bucket name, just verify credentials and return
+            if bucket_name is None:
+                logger.info("✅ AWS credentials verified (S3 bucket tests skipped)")
+                return True
+            
+            # Upload to temporary location in Replit Object Storage first, under
+            # its own name as test_replit_storage runs at the same time
+            object_name = f"backups/test/s3_{backup_info['filename']}"
+            logger.info("Creating temporary object for S3 test: %s", object_name)
+            
+            if not STORAGE_CLIENT:
+                logger.error("❌ Replit Object Storage client not available")
+                return False
+            
+            STORAGE_CLIENT.upload_from_filename(object_name, backup_info["path"])
+            cleanup.callback(STORAGE_CLIENT.delete, object_name)
+            
+            # Test transferring to S3
+            logger.info("Testing transfer to S3 bucket: %s", bucket_name)
+            
+            # Check if bucket exists
             try:
-                response = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-                s3_size = response['ContentLength'] / (1024 * 1024)
-                logger.info(f"✅ Object verified in S3 ({s3_size:.2f} MB)")
+                s3_client.head_bucket(Bucket=bucket_name)
+                logger.info("✅ S3 bucket %s exists and is accessible", bucket_name)
             except Exception as e:
-                logger.error(f"❌ Error verifying S3 object: {str(e)}")
+                logger.error("❌ S3 bucket error: %s", e)
+                return False
             
-            # Clean up S3
+            # Upload to S3
             try:
-                s3_client.delete_object(Bucket=bucket_name, Key=s3_key)
-                logger.info(f"✅ Test object deleted from S3")
+                # Stream the upload from the spooled backup file, with the same
+                # multipart settings offsite backups use for this size
+                s3_key = f"test/{backup_info['filename']}"
+                backup_file = backup_info["backup_file"]
+                backup_file.seek(0)
+                s3_client.upload_fileobj(
+                    backup_file,
+                    bucket_name,
+                    s3_key,
+                    # S3 verifies each part's CRC32 as it is received, so a
+                    # corrupted upload fails here without a separate check
+                    # (CRC32C would need the optional awscrt package)
+                    ExtraArgs={'ChecksumAlgorithm': 'CRC32'},
+                    Config=get_transfer_config(backup_info["size"])
+                )
+                logger.info("✅ Direct upload to S3 successful, checksum verified (%.2f MB)", backup_info['size_mb'])
+                
+                # Clean up S3
+                try:
+                    s3_client.delete_object(Bucket=bucket_name, Key=s3_key)
+                    logger.info("✅ Test object deleted from S3")
+                except Exception as e:
+                    logger.error("❌ Error deleting test object from S3: %s", e)
             except Exception as e:
-                logger.error(f"❌ Error deleting test object from S3: {str(e)}")
-        except Exception as e:
-            logger.error(f"❌ Error uploading to S3: {str(e)}")
-        
-        # Clean up Replit Object Storage
-        if object_name:
-            STORAGE_CLIENT.delete(object_name)
-        
-        return True
+                logger.error("❌ Error uploading to S3: %s", e)
+                return False
+            
+            return True
     
     except Exception as e:
-        logger.error(f"❌ Error testing AWS S3 offsite backup: {str(e)}")
-        # Attempt to clean up
-        try:
-            if STORAGE_CLIENT and object_name:
-                STORAGE_CLIENT.delete(object_name)
-        except:
-            pass
+        logger.error("❌ Error testing AWS S3 offsite backup: %s", e)
         return False
 
 def test_restore_capability(backup_info):
     """Test the restore capability"""
     logger.info("\n=== TESTING RESTORE CAPABILITY ===")
     
-    if not backup_info or not backup_info.get("backup_data"):
+    if not backup_info or not backup_info.get("backup_file"):
         logger.error("❌ No backup data available to test")
         return False
     
     try:
-        # Create a temporary file for the backup
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(backup_info["backup_data"])
-            temp_path = temp_file.name
-        
-        logger.info(f"Created temporary file for restore test: {temp_path}")
+        # Test against the spooled backup file
+        temp_path = backup_info["path"]
+        logger.info("Using backup file for restore test: %s", temp_path)
         
         # For plain SQL files, just check file size and try to gunzip to test validity
         try:
-            # Check file size
-            file_size = os.path.getsize(temp_path)
-            logger.info(f"Backup file size: {file_size / 1024:.2f} KB")
+            # Check file size (recorded when the backup was spooled)
+            file_size = backup_info["size"]
+            logger.info("Backup file size: %.2f KB", file_size / 1024)
             
             if file_size < 100:  # If less than 100 bytes, probably empty
-                logger.warning(f"⚠️ Backup file is very small ({file_size} bytes)")
+                logger.warning("⚠️ Backup file is very small (%d bytes)", file_size)
+            
+            # Check the gzip magic bytes before trying to decompress
+            with open(temp_path, 'rb') as f:
+                if f.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+                    logger.error("❌ Backup file is not gzip-compressed")
+                    return False
             
             # Try to decompress gzip file to verify integrity
             with gzip.open(temp_path, 'rb') as f:
@@ -261,27 +288,25 @@ def test_restore_capability(backup_info):
                 sample = f.read(1024)
                 if sample:
                     logger.info("✅ Backup file is valid (gzip format can be decompressed)")
+                    if not sample.startswith(SQL_DUMP_HEADER):
+                        logger.warning("⚠️ Backup does not start with the expected SQL dump header")
                     # Print a small sample of SQL
                     try:
                         sample_text = sample.decode('utf-8')[:500]
                         if len(sample) > 500:
                             sample_text += "... (truncated)"
-                        logger.info(f"Backup contents preview:\n{sample_text}")
+                        logger.info("Backup contents preview:\n%s", sample_text)
                     except UnicodeDecodeError:
                         logger.warning("⚠️ Unable to decode backup sample as UTF-8")
                 else:
                     logger.warning("⚠️ Backup file contains no data")
         except Exception as e:
-            logger.error(f"❌ Error testing backup validity: {str(e)}")
-        
-        # Clean up
-        os.unlink(temp_path)
-        logger.info("Temporary file deleted")
+            logger.error("❌ Error testing backup validity: %s", e)
         
         return True
     
     except Exception as e:
-        logger.error(f"❌ Error testing restore capability: {str(e)}")
+        logger.error("❌ Error testing restore capability: %s", e)
         return False
 
 def run_all_tests():
@@ -290,19 +315,26 @@ def run_all_tests():
     logger.info("=======================================")
     
     # Step 1: Create test backup
-    backup_info = test_create_backup()
-    if not backup_info:
-        logger.error("Backup creation failed, cannot continue tests")
-        return False
-    
-    # Step 2: Test Replit Object Storage
-    replit_storage_success = test_replit_storage(backup_info)
-    
-    # Step 3: Test AWS S3 offsite backup
-    aws_s3_success = test_aws_s3(backup_info)
-    
-    # Step 4: Test restore capability
-    restore_success = test_restore_capability(backup_info)
+    with backup_context() as backup_info:
+        if not backup_info:
+            logger.error("Backup creation failed, cannot continue tests")
+            return False
+        
+        # Steps 2-4 only read the backup and are I/O-bound, so run them
+        # concurrently; their log output may interleave
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # Step 2: Test Replit Object Storage
+            replit_storage_future = executor.submit(test_replit_storage, backup_info)
+            
+            # Step 3: Test AWS S3 offsite backup
+            aws_s3_future = executor.submit(test_aws_s3, backup_info)
+            
+            # Step 4: Test restore capability
+            restore_future = executor.submit(test_restore_capability, backup_info)
+            
+            replit_storage_success = replit_storage_future.result()
+            aws_s3_success = aws_s3_future.result()
+            restore_success = restore_future.result()
     
     # Summary
     logger.info("\n=== TEST SUMMARY ===")
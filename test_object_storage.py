@@ -1,4 +1,5 @@
 import sys
+import importlib.util
 print("Python version:", sys.version)
 print("Path:", sys.path)
 
@@ -27,21 +28,17 @@ try:
 except ImportError as e:
     print(f"Error importing replit: {str(e)}")
 
-# Try alternative import paths mentioned in documentation
+# Try alternative import paths mentioned in documentation; find_spec does not
+# run the module itself, but it does import the parent packages of a dotted
+# name (replit and replit.extensions)
 print("\nTrying alternative imports:")
-try:
-    import replit_object_storage
-    print("Successfully imported replit_object_storage")
-except ImportError as e:
-    print(f"Error importing replit_object_storage: {str(e)}")
-
-try:
-    from replit import extensions
-    print("Extensions module exists:", extensions)
+for module_name in ("replit_object_storage", "replit.extensions", "replit.extensions.objectstorage"):
     try:
-        from replit.extensions import objectstorage
-        print("Successfully imported from replit.extensions.objectstorage")
-    except ImportError as e:
-        print(f"Error importing from replit.extensions.objectstorage: {str(e)}")
-except ImportError as e:
-    print(f"Error importing replit.extensions: {str(e)}")
\ No newline at end of file
+        spec = importlib.util.find_spec(module_name)
+    except ImportError:
+        # The parent package is missing
+        spec = None
+    if spec is not None:
+        print(f"Found module {module_name}")
+    else:
+        print(f"Module {module_name} not found")
@@ -1,103 +1,108 @@
 import logging
 import json
 from datetime import datetime, timedelta
+from flask import g
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
 from app import db
-from models import TelegramMessage, SyncStatus, Setting
+from models import Setting
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
+# Daily counts between :start and :end, with a row for every day in the range
+# (generate_series) so days without activity come back as zeros
+MESSAGE_STATS_SQL = text("""
+    SELECT d::date AS date, COALESCE(x.count, 0) AS count
+    FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') AS d
+    LEFT JOIN (
+        SELECT date(timestamp) AS day, count(*) AS count
+        FROM telegram_message
+        WHERE timestamp BETWEEN :start AND :end
+        GROUP BY 1
+    ) AS x ON x.day = d::date
+    ORDER BY 1
+""")
+
+SYNC_STATS_SQL = text("""
+    SELECT d::date AS date, COALESCE(x.success, 0) AS success, COALESCE(x.failure, 0) AS failure
+    FROM generate_series(CAST(:start AS date), CAST(:end AS date), interval '1 day') AS d
+    LEFT JOIN (
+        SELECT date(timestamp) AS day,
+               SUM(CASE WHEN success THEN 1 ELSE 0 END) AS success,
+               SUM(CASE WHEN NOT success THEN 1 ELSE 0 END) AS failure
+        FROM sync_status
+        WHERE timestamp BETWEEN :start AND :end
+          AND success IS NOT NULL  -- matches the partial index; NULLs count as neither
+        GROUP BY 1
+    ) AS x ON x.day = d::date
+    ORDER BY 1
+""")
+
+# All settings, loaded once per app context
+ALL_SETTINGS_SELECT = select(Setting.key, Setting.value)
+
+def _settings_cache():
+    """Get all settings for the current app context, loaded with one query"""
+    if 'settings_cache' not in g:
+        g.settings_cache = dict(db.session.execute(ALL_SETTINGS_SELECT).all())
+    return g.settings_cache
+
 def get_setting(key, default=None):
-    """Get a setting value from the database"""
-    setting = Setting.query.filter_by(key=key).first()
-    if setting and setting.value:
-        return setting.value
+    """Get a setting value from the database; needs an app context like db.session"""
+    value = _settings_cache().get(key)
+    if value:
+        return value
     return default
 
 def set_setting(key, value):
     """Set a setting value in the database"""
-    setting = Setting.query.filter_by(key=key).first()
-    if setting:
-        setting.value = value
-    else:
-        setting = Setting(key=key, value=value)
-        db.session.add(setting)
+    # Single upsert instead of a SELECT followed by an INSERT or UPDATE;
+    # returning the row with populate_existing refreshes a Setting already
+    # loaded in the session, which a plain Core upsert would leave stale
+    stmt = insert(Setting).values(key=key, value=value)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Setting.key],
+        set_={'value': value, 'last_updated': datetime.utcnow()}
+    ).returning(Setting)
+    db.session.execute(stmt, execution_options={'populate_existing': True})
     db.session.commit()
+    
+    if 'settings_cache' in g:
+        g.settings_cache[key] = value
     return True
 
 def get_message_stats(days=7):
     """Get message statistics for the last X days"""
-    from sqlalchemy import func
-    
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
     
-    # Get message counts by day
-    results = db.session.query(
-        func.date(TelegramMessage.timestamp).label('date'),
-        func.count().label('count')
-    ).filter(
-        TelegramMessage.timestamp >= start_date,
-        TelegramMessage.timestamp <= end_date
-    ).group_by(
-        func.date(TelegramMessage.timestamp)
-    ).order_by(
-        func.date(TelegramMessage.timestamp)
-    ).all()
+    # One row per day, zero-filled by the database
+    results = db.session.execute(MESSAGE_STATS_SQL, {'start': start_date, 'end': end_date})
     
     # Convert to dictionary with date as key
     stats = {}
     for date, count in results:
-        stats[date.strftime('%Y-%m-%d')] = count
-    
-    # Fill in missing dates with zero counts
-    current_date = start_date
-    while current_date <= end_date:
-        date_str = current_date.strftime('%Y-%m-%d')
-        if date_str not in stats:
-            stats[date_str] = 0
-        current_date += timedelta(days=1)
+        stats[date.isoformat()] = count
     
     return stats
 
 def get_sync_stats(days=7):
-    """Get sync statistics for the last X days"""
-    from sqlalchemy import func, case
-    
+    """Get sync statistics for the last X days
+
+    Returns parallel lists, one entry per day in date order:
+    {'dates': [...], 'success': [...], 'failure': [...]}
+    """
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
     
-    # Get sync status counts by day
-    results = db.session.query(
-        func.date(SyncStatus.timestamp).label('date'),
-        func.sum(case((SyncStatus.success == True, 1), else_=0)).label('success'),
-        func.sum(case((SyncStatus.success == False, 1), else_=0)).label('failure')
-    ).filter(
-        SyncStatus.timestamp >= start_date,
-        SyncStatus.timestamp <= end_date
-    ).group_by(
-        func.date(SyncStatus.timestamp)
-    ).order_by(
-        func.date(SyncStatus.timestamp)
-    ).all()
+    # One row per day, zero-filled by the database
+    results = db.session.execute(SYNC_STATS_SQL, {'start': start_date, 'end': end_date}).all()
     
-    # Convert to dictionary with date as key
-    stats = {}
-    for date, success, failure in results:
-        stats[date.strftime('%Y-%m-%d')] = {
-            'success': success or 0,
-            'failure': failure or 0
-        }
-    
-    # Fill in missing dates with zero counts
-    current_date = start_date
-    while current_date <= end_date:
-        date_str = current_date.strftime('%Y-%m-%d')
-        if date_str not in stats:
-            stats[date_str] = {
-                'success': 0,
-                'failure': 0
-            }
-        current_date += timedelta(days=1)
-    
-    return stats
+    # Split the rows into one list per column
+    dates, success, failure = zip(*results) if results else ((), (), ())
+    return {
+        'dates': [date.isoformat() for date in dates],
+        'success': list(success),
+        'failure': list(failure)
+    }